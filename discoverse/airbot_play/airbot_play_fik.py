@@ -1,7 +1,118 @@
+import os
+import math
+import pickle
+
 import numpy as np
 import pinocchio as pin
 from scipy.spatial.transform import Rotation
 
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        def decorator(func):
+            return func
+        return decorator
+
+@njit(cache=True, fastmath=True)
+def _fk_kernel(q, placements, axes):
+    T = np.eye(4)
+    for i in range(q.shape[0]):
+        c = math.cos(q[i])
+        s = math.sin(q[i])
+        ic = 1.0 - c
+        ax = axes[i, 0]
+        ay = axes[i, 1]
+        az = axes[i, 2]
+        A = np.zeros((4, 4))
+        A[0, 0] = ax * ax * ic + c
+        A[0, 1] = ax * ay * ic - az * s
+        A[0, 2] = ax * az * ic + ay * s
+        A[1, 0] = ax * ay * ic + az * s
+        A[1, 1] = ay * ay * ic + c
+        A[1, 2] = ay * az * ic - ax * s
+        A[2, 0] = ax * az * ic - ay * s
+        A[2, 1] = ay * az * ic + ax * s
+        A[2, 2] = az * az * ic + c
+        A[3, 3] = 1.0
+        T = T @ (placements[i] @ A)
+    return T
+
+@njit(cache=True, fastmath=True)
+def _inverse_kin_kernel(pos, ori, a1, a3, a4, bias, lo, hi):
+    out = np.empty((8, 6))
+    valid = np.zeros(8, np.bool_)
+
+    xy_sq = pos[0] * pos[0] + pos[1] * pos[1]
+    r_xy = math.sqrt(xy_sq)
+    dz = pos[2] - a1
+    c3 = (xy_sq + dz * dz - a3 * a3 - a4 * a4) / (2 * a3 * a4)
+    if c3 > 1.0 or c3 < -1.0:
+        return out, valid
+
+    two_pi = 2.0 * math.pi
+    idx = 0
+    for i1 in (1.0, -1.0):
+        angle0 = math.atan2(i1 * pos[1], i1 * pos[0])
+        j0 = angle0 + bias[0]
+        j0 -= two_pi * math.floor((j0 + math.pi) / two_pi)
+        if j0 <= lo[0] or j0 >= hi[0]:
+            idx += 4
+            continue
+        for i2 in (1.0, -1.0):
+            s3 = i2 * math.sqrt(1.0 - c3 * c3)
+            angle2 = math.atan2(s3, c3)
+            j2 = angle2 + bias[2]
+            j2 -= two_pi * math.floor((j2 + math.pi) / two_pi)
+            if j2 <= lo[2] or j2 >= hi[2]:
+                idx += 2
+                continue
+            k1 = a3 + a4 * c3
+            k2 = a4 * s3
+            angle1 = math.atan2(k1 * dz - i1 * k2 * r_xy, i1 * k1 * r_xy + k2 * dz)
+            j1 = angle1 + bias[1]
+            j1 -= two_pi * math.floor((j1 + math.pi) / two_pi)
+            if j1 <= lo[1] or j1 >= hi[1]:
+                idx += 2
+                continue
+            c0 = math.cos(angle0)
+            s0 = math.sin(angle0)
+            c23 = math.cos(angle1 + angle2)
+            s23 = math.sin(angle1 + angle2)
+            # ori1 = R.T @ ori, expanded to the five entries read below
+            ori1_00 =  c0 * c23 * ori[0, 0] + s0 * c23 * ori[1, 0] + s23 * ori[2, 0]
+            ori1_01 =  c0 * c23 * ori[0, 1] + s0 * c23 * ori[1, 1] + s23 * ori[2, 1]
+            ori1_02 =  c0 * c23 * ori[0, 2] + s0 * c23 * ori[1, 2] + s23 * ori[2, 2]
+            ori1_12 = -c0 * s23 * ori[0, 2] - s0 * s23 * ori[1, 2] + c23 * ori[2, 2]
+            ori1_22 =  s0 * ori[0, 2] - c0 * ori[1, 2]
+            for i5 in (1.0, -1.0):
+                j3 = math.atan2(i5 * ori1_22, i5 * ori1_12) + bias[3]
+                j3 -= two_pi * math.floor((j3 + math.pi) / two_pi)
+                if j3 <= lo[3] or j3 >= hi[3]:
+                    idx += 1
+                    continue
+                j4 = math.atan2(i5 * math.sqrt(ori1_22 * ori1_22 + ori1_12 * ori1_12), ori1_02) + bias[4]
+                j4 -= two_pi * math.floor((j4 + math.pi) / two_pi)
+                if j4 <= lo[4] or j4 >= hi[4]:
+                    idx += 1
+                    continue
+                j5 = math.atan2(-i5 * ori1_00, -i5 * ori1_01) + bias[5]
+                j5 -= two_pi * math.floor((j5 + math.pi) / two_pi)
+                if j5 <= lo[5] or j5 >= hi[5]:
+                    idx += 1
+                    continue
+                out[idx, 0] = j0
+                out[idx, 1] = j1
+                out[idx, 2] = j2
+                out[idx, 3] = j3
+                out[idx, 4] = j4
+                out[idx, 5] = j5
+                valid[idx] = True
+                idx += 1
+    return out, valid
+
 class AirbotPlayFIK:
     bias = np.array([0.0, -2.7549, 2.7549, 1.5708, 0.0, 0.0])
     a1 = 0.1172
@@ -20,116 +131,203 @@ class AirbotPlayFIK:
         [-1.,  0.,  0.]
     ])
 
+    _a3sq_plus_a4sq = a3 ** 2 + a4 ** 2
+    _two_a3a4 = 2 * a3 * a4
+    _arm_rot_mat_T = arm_rot_mat.T
+    _joint_range_scale_recip = 1.0 / joint_range_scale
+
+    _shared_instances = {}
+
     def __init__(self, urdf) -> None:
-        self.pin_model = pin.buildModelFromUrdf(urdf)
+        self.pin_model = self._load_pin_model(urdf)
         self.pin_data = self.pin_model.createData()
+        self._properik_ori_key = None
+        self._properik_ori = None
+        self._fk_placements, self._fk_axes = self._build_fk_constants()
+
+    def _build_fk_constants(self):
+        """Per-joint constant placements and rotation axes for _fk_kernel;
+        (None, None) when the model is not a serial chain of 1-dof revolute
+        joints, in which case forwardKin falls back to pinocchio."""
+        if self.pin_model.njoints < 7:
+            return None, None
+        placements = np.empty((6, 4, 4))
+        axes = np.empty((6, 3))
+        for i in range(6):
+            jid = i + 1
+            joint = self.pin_model.joints[jid]
+            if self.pin_model.parents[jid] != jid - 1 or joint.nq != 1 or joint.nv != 1:
+                return None, None
+            name = joint.shortname()
+            if name.endswith("RX"):
+                axes[i] = (1., 0., 0.)
+            elif name.endswith("RY"):
+                axes[i] = (0., 1., 0.)
+            elif name.endswith("RZ"):
+                axes[i] = (0., 0., 1.)
+            elif hasattr(joint, "axis"):
+                axes[i] = joint.axis
+            else:
+                return None, None
+            placements[i] = self.pin_model.jointPlacements[jid].homogeneous
+        return placements, axes
+
+    @staticmethod
+    def _load_pin_model(urdf):
+        cache_path = urdf + ".pin.pkl"
+        try:
+            if os.path.getmtime(cache_path) >= os.path.getmtime(urdf):
+                with open(cache_path, "rb") as fp:
+                    return pickle.load(fp)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            pass
+        pin_model = pin.buildModelFromUrdf(urdf)
+        try:
+            with open(cache_path, "wb") as fp:
+                pickle.dump(pin_model, fp)
+        except OSError:
+            pass
+        return pin_model
+
+    @classmethod
+    def from_cached(cls, urdf):
+        if urdf not in cls._shared_instances:
+            cls._shared_instances[urdf] = cls(urdf)
+        return cls._shared_instances[urdf]
 
     def forwardKin(self, q) -> pin.SE3:
-        pin.forwardKinematics(self.pin_model, self.pin_data, q)
-        return self.pin_data.oMi[6]
+        if self._fk_placements is None:
+            pin.forwardKinematics(self.pin_model, self.pin_data, q)
+            return self.pin_data.oMi[6]
+        tmat = _fk_kernel(np.asarray(q, dtype=np.float64), self._fk_placements, self._fk_axes)
+        return pin.SE3(tmat[:3, :3].copy(), tmat[:3, 3].copy())
 
     def properIK(self, pos, ori, ref_q=None):
-        return self.inverseKin(pos, ori @ self.arm_rot_mat, ref_q)
+        key = ori.tobytes()
+        if key != self._properik_ori_key:
+            self._properik_ori_key = key
+            self._properik_ori = ori @ self.arm_rot_mat
+        return self.inverseKin(pos, self._properik_ori, ref_q)
 
     def properFK(self, q) -> pin.SE3:
         eoMi = self.forwardKin(np.array(q))
         tmat = np.eye(4)
-        tmat[:3,:3] = eoMi.rotation @ self.arm_rot_mat.T
+        tmat[:3,:3] = eoMi.rotation @ self._arm_rot_mat_T
         tmat[:3,3] = eoMi.translation.T
         return tmat
 
     def inverseKin(self, pos, ori, ref_q=None):
         assert len(pos) == 3 and ori.shape == (3,3)
         pos = self.move_joint6_2_joint5(pos, ori)
-        angle = [0.0] * 6
-        ret = []
-
-        for i1 in [1, -1]:
-            angle[0] = np.arctan2(i1 * pos[1], i1 * pos[0])
-            c3 = (pos[0] ** 2 + pos[1] ** 2 + (pos[2] - self.a1) ** 2 - self.a3 ** 2 - self.a4 ** 2) / (2 * self.a3 * self.a4)
-            if c3 > 1 or c3 < -1:
-                raise ValueError("Fail to solve inverse kinematics: pos={}, ori={}".format(pos, ori))
-
-            for i2 in [1, -1]:
-                s3 = i2 * np.sqrt(1 - c3 ** 2)
-                angle[2] = np.arctan2(s3, c3)
-                k1 = self.a3 + self.a4 * c3
-                k2 = self.a4 * s3
-                angle[1] = np.arctan2(k1 * (pos[2] - self.a1) - i1 * k2 * np.sqrt(pos[0] ** 2 + pos[1] ** 2),
-                                   i1 * k1 * np.sqrt(pos[0] ** 2 + pos[1] ** 2) + k2 * (pos[2] - self.a1))
-                R = np.array([
-                    [np.cos(angle[0]) * np.cos(angle[1] + angle[2]),
-                     -np.cos(angle[0]) * np.sin(angle[1] + angle[2]),
-                     np.sin(angle[0])],
-                    [np.sin(angle[0]) * np.cos(angle[1] + angle[2]),
-                     -np.sin(angle[0]) * np.sin(angle[1] + angle[2]),
-                     -np.cos(angle[0])],
-                    [np.sin(angle[1] + angle[2]), np.cos(angle[1] + angle[2]), 0]
-                ])
-                ori1 = R.T @ ori
-                for i5 in [1, -1]:
-                    angle[3] = np.arctan2(i5 * ori1[2, 2], i5 * ori1[1, 2])
-                    angle[4] = np.arctan2(i5 * np.sqrt(ori1[2, 2] ** 2 + ori1[1, 2] ** 2), ori1[0, 2])
-                    angle[5] = np.arctan2(-i5 * ori1[0, 0], -i5 * ori1[0, 1])
-                    js = self.add_bias(angle)
-                    if np.all((js > self.arm_joint_range[0]) * (js < self.arm_joint_range[1])):
-                        ret.append(js)
-        if len(ret) == 0:
+        out, valid = _inverse_kin_kernel(
+            np.asarray(pos, dtype=np.float64), np.ascontiguousarray(ori, dtype=np.float64),
+            self.a1, self.a3, self.a4, self.bias, self.arm_joint_range[0], self.arm_joint_range[1]
+        )
+        cands = out[valid]
+        if cands.shape[0] == 0:
             raise ValueError("Fail to solve inverse kinematics: pos={}, ori={}".format(pos, ori))
 
         if ref_q is not None:
-            joint_dist_lst = []
-            for js in ret:
-                joint_dist_lst.append(np.sum(np.abs(ref_q - js) / self.joint_range_scale))
-            q = ret[np.argmin(joint_dist_lst)]
-            return q
+            dists = np.abs(cands - ref_q) @ self._joint_range_scale_recip
+            return cands[np.argmin(dists)]
         else:
-            return ret
+            return list(cands)
+
+    def inverseKinBatch(self, pos, ori, ref_q=None):
+        """
+            pos   : (N,3) target positions of joint6
+            ori   : (N,3,3) target orientations of joint6
+            ref_q : optional (N,6) or (6,) reference joint angles
+            Returns (js, valid) with js (N,8,6) and valid (N,8) when ref_q is None,
+            otherwise the per-row nearest valid solution (N,6); rows without a
+            valid solution are filled with NaN instead of raising.
+        """
+        pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)
+        ori = np.asarray(ori, dtype=np.float64).reshape(-1, 3, 3)
+        pos = pos - ori[:, :, 2] * self.a6
+
+        i1 = np.array([1., 1., 1., 1., -1., -1., -1., -1.]).reshape(8, 1)
+        i2 = np.array([1., 1., -1., -1., 1., 1., -1., -1.]).reshape(8, 1)
+        i5 = np.array([1., -1., 1., -1., 1., -1., 1., -1.]).reshape(8, 1)
+
+        x, y = pos[:, 0], pos[:, 1]
+        dz = pos[:, 2] - self.a1
+        r_xy = np.hypot(x, y)
+        c3 = (x * x + y * y + dz * dz - self._a3sq_plus_a4sq) / self._two_a3a4
+        c3 = np.where(np.abs(c3) > 1., np.nan, c3)
+
+        angle0 = np.arctan2(i1 * y, i1 * x)
+        s3 = i2 * np.sqrt(1. - c3 * c3)
+        angle2 = np.arctan2(s3, c3)
+        k1 = self.a3 + self.a4 * c3
+        k2 = self.a4 * s3
+        angle1 = np.arctan2(k1 * dz - i1 * k2 * r_xy, i1 * k1 * r_xy + k2 * dz)
+
+        c0, s0 = np.cos(angle0), np.sin(angle0)
+        c23, s23 = np.cos(angle1 + angle2), np.sin(angle1 + angle2)
+        R = np.empty((8, pos.shape[0], 3, 3))
+        R[..., 0, 0] =  c0 * c23
+        R[..., 0, 1] = -c0 * s23
+        R[..., 0, 2] =  s0
+        R[..., 1, 0] =  s0 * c23
+        R[..., 1, 1] = -s0 * s23
+        R[..., 1, 2] = -c0
+        R[..., 2, 0] =  s23
+        R[..., 2, 1] =  c23
+        R[..., 2, 2] =  0.
+        ori1 = R.transpose(0, 1, 3, 2) @ ori
+
+        angle3 = np.arctan2(i5 * ori1[..., 2, 2], i5 * ori1[..., 1, 2])
+        angle4 = np.arctan2(i5 * np.sqrt(ori1[..., 2, 2] ** 2 + ori1[..., 1, 2] ** 2), ori1[..., 0, 2])
+        angle5 = np.arctan2(-i5 * ori1[..., 0, 0], -i5 * ori1[..., 0, 1])
+
+        js = np.stack([angle0, angle1, angle2, angle3, angle4, angle5], axis=-1)
+        js = (js + self.bias + np.pi) % (2. * np.pi) - np.pi
+        valid = ((js > self.arm_joint_range[0]) & (js < self.arm_joint_range[1])).all(-1)
+        js, valid = js.transpose(1, 0, 2), valid.T
+
+        if ref_q is None:
+            return js, valid
+
+        ref_q = np.asarray(ref_q, dtype=np.float64).reshape(-1, 6)
+        dists = (np.abs(js - ref_q[:, None, :]) / self.joint_range_scale).sum(-1)
+        dists[~valid] = np.inf
+        q = js[np.arange(js.shape[0]), np.argmin(dists, axis=1)]
+        q[~valid.any(axis=1)] = np.nan
+        return q
 
     def add_bias(self, angle):
-        ret = []
-        for i in range(len(angle)):
-            a = angle[i] + self.bias[i]
-            while a > np.pi:
-                a -= 2 * np.pi
-            while a < -np.pi:
-                a += 2 * np.pi
-            ret.append(a)
-        return ret
+        angle = np.asarray(angle)
+        return (angle + self.bias[:angle.shape[0]] + np.pi) % (2 * np.pi) - np.pi
 
     def move_joint6_2_joint5(self, pos, ori):
-        ret = np.array([
-            -ori[0, 2] * self.a6 + pos[0],
-            -ori[1, 2] * self.a6 + pos[1],
-            -ori[2, 2] * self.a6 + pos[2]
-        ])
-        return ret
+        return np.asarray(pos) - ori[:, 2] * self.a6
 
     def j3_ik(self, pos):
         angle = [0.0] * 3
         ret = []
 
-        for i1 in [1, -1]:
-            angle[0] = np.arctan2(i1 * pos[1], i1 * pos[0])
-            c3 = (pos[0] ** 2 + pos[1] ** 2 + (pos[2] - self.a1) ** 2 - self.a3 ** 2 - self.a4 ** 2) / (2 * self.a3 * self.a4)
-            if c3 > 1 or c3 < -1:
-                raise ValueError("Fail to solve inverse kinematics")
+        r_xy = math.hypot(pos[0], pos[1])
+        dz = pos[2] - self.a1
+        c3 = (r_xy * r_xy + dz * dz - self._a3sq_plus_a4sq) / self._two_a3a4
+        if c3 > 1 or c3 < -1:
+            raise ValueError("Fail to solve inverse kinematics")
 
+        for i1 in [1, -1]:
+            angle[0] = math.atan2(i1 * pos[1], i1 * pos[0])
             for i2 in [1, -1]:
-                s3 = i2 * np.sqrt(1 - c3 ** 2)
-                angle[2] = np.arctan2(s3, c3)
+                s3 = i2 * math.sqrt(1 - c3 * c3)
+                angle[2] = math.atan2(s3, c3)
                 k1 = self.a3 + self.a4 * c3
                 k2 = self.a4 * s3
-                angle[1] = np.arctan2(k1 * (pos[2] - self.a1) - i1 * k2 * np.sqrt(pos[0] ** 2 + pos[1] ** 2),
-                                   i1 * k1 * np.sqrt(pos[0] ** 2 + pos[1] ** 2) + k2 * (pos[2] - self.a1))
+                angle[1] = math.atan2(k1 * dz - i1 * k2 * r_xy,
+                                   i1 * k1 * r_xy + k2 * dz)
                 js = self.add_bias(angle)
                 if np.all((js > self.arm_joint_range[0,:3]) * (js < self.arm_joint_range[1,:3])):
                     ret.append(js)
         return ret
 
 if __name__ == "__main__":
-    import os
-
     np.set_printoptions(precision=3, suppress=True, linewidth=200)
     arm_fik = AirbotPlayFIK(urdf = os.path.join(os.path.dirname(__file__), "../../models/urdf/airbot_play_v3_gripper_fixed.urdf"))
 
@@ -18,9 +18,17 @@ class AirbotPlayIK_nopin:
         [-1.,  0.,  0.]
     ])
 
+    _shared_instances = {}
+
     def __init__(self, urdf) -> None:
         pass
 
+    @classmethod
+    def from_cached(cls, urdf):
+        if urdf not in cls._shared_instances:
+            cls._shared_instances[urdf] = cls(urdf)
+        return cls._shared_instances[urdf]
+
     def properIK(self, pos, ori, ref_q=None):
         return self.inverseKin(pos, ori @ self.arm_rot_mat, ref_q)
 
@@ -3,14 +3,17 @@ import numpy as np
 from scipy.spatial.transform import Rotation
 
 import os
+import math
 import shutil
 import argparse
-import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 
 from discoverse import DISCOVERSE_ROOT_DIR
 from discoverse.envs.mmk2_base import MMK2Cfg
-from discoverse.task_base import MMK2TaskBase, recoder_mmk2, copypy2
-from discoverse.utils import get_body_tmat, step_func, SimpleStateMachine
+from discoverse.task_base import MMK2TaskBase, recoder_mmk2_buffered, copypy2
+from discoverse.utils import get_body_tmat, step_func_vec, SimpleStateMachine
+
+EE_ORIENTATION = Rotation.from_euler('zyx', [0., -0.0551, 0.]).as_matrix()
 
 class SimNode(MMK2TaskBase):
 
@@ -86,18 +89,50 @@ if __name__ == "__main__":
     stm.max_state_cnt = 16
     max_time = 20.0 #s
 
+    # per-episode recording buffers, written in place each frame instead of
+    # growing python lists of per-frame dicts
+    fps = cfg.render_set["fps"]
+    max_frames = int(max_time * fps)
+    frame_hw = (cfg.render_set["height"], cfg.render_set["width"])
+    act_buf = np.empty((max_frames, sim_node.njctrl))
+    obs_buf = {
+        "time"             : np.empty(max_frames),
+        "jq"               : np.empty((max_frames, sim_node.io_dim)),
+        "base_position"    : np.empty((max_frames, 3)),
+        "base_orientation" : np.empty((max_frames, 4)),
+    }
+    # a fresh set of frame blocks is allocated after each handoff so the
+    # writer threads keep sole ownership of what they are saving
+    def alloc_img_buf():
+        return {id: np.empty((max_frames,) + frame_hw + (3,), dtype=np.uint8) for id in cfg.obs_rgb_cam_id}
+
+    img_buf = alloc_img_buf()
+    frame_idx = 0
+
     action = np.zeros_like(sim_node.target_control)
-    process_list = []
+    # two long-lived writer threads: numpy and the video encoder release the
+    # GIL, so episode I/O overlaps simulation without per-episode process startup
+    io_pool = ThreadPoolExecutor(max_workers=2)
+    io_futures = []
 
     pick_lip_arm = "r"
     move_speed = 1.
     obs = sim_node.reset()
+
+    # body transforms only change after sim_node.step, so they are memoized per tick
+    sim_node._tmat_cache = {}
+    def get_body_tmat_cached(body_name):
+        if body_name not in sim_node._tmat_cache:
+            sim_node._tmat_cache[body_name] = get_body_tmat(sim_node.mj_data, body_name)
+        return sim_node._tmat_cache[body_name]
+
     while sim_node.running:
+        sim_node._tmat_cache.clear()
         if sim_node.reset_sig:
             sim_node.reset_sig = False
             stm.reset()
             action[:] = sim_node.target_control[:]
-            act_lst, obs_lst = [], []
+            frame_idx = 0
 
         try:
             if stm.trigger():
@@ -105,56 +140,48 @@ if __name__ == "__main__":
                     sim_node.tctr_head[1] = 0.8
                     sim_node.tctr_slide[0] = 0.2
                 elif stm.state_idx == 1: # 伸到杯子前
-                    tmat_coffee = get_body_tmat(sim_node.mj_data, "coffeecup_white")
+                    tmat_coffee = get_body_tmat_cached("coffeecup_white")
                     target_posi = tmat_coffee[:3, 3] + 0.1 * tmat_coffee[:3, 1] + 0.1 * tmat_coffee[:3, 2]
-                    sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                    sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                    sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                     sim_node.tctr_lft_gripper[:] = 1
                 elif stm.state_idx == 2: # 伸到杯把
-                    tmat_coffee = get_body_tmat(sim_node.mj_data, "coffeecup_white")
+                    tmat_coffee = get_body_tmat_cached("coffeecup_white")
                     target_posi = tmat_coffee[:3, 3] + 0.045 * tmat_coffee[:3, 1] + 0.05 * tmat_coffee[:3, 2]
-                    sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                    sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                    sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 3: # 抓住杯把
                     sim_node.tctr_lft_gripper[:] = 0.0
                     sim_node.delay_cnt = int(0.5/sim_node.delta_t)
                 elif stm.state_idx == 4: # 提起来杯子
                     sim_node.tctr_slide[0] = 0.1
                 elif stm.state_idx == 5: # 把杯子放到盘子上空
-                    tmat_plate = get_body_tmat(sim_node.mj_data, "plate_white")
+                    tmat_plate = get_body_tmat_cached("plate_white")
                     target_posi = tmat_plate[:3, 3] + np.array([0.0, 0.045, 0.16])
-                    sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                    sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                    sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 6: # 下降高度
                     sim_node.tctr_slide[0] = 0.2
                 elif stm.state_idx == 7: # 松开杯把 放下杯子
                     sim_node.tctr_lft_gripper[:] = 1
                 elif stm.state_idx == 8: # 移开手臂
-                    tmat_plate = get_body_tmat(sim_node.mj_data, "plate_white")
+                    tmat_plate = get_body_tmat_cached("plate_white")
                     target_posi = tmat_plate[:3, 3] + np.array([0.0, 0.16, 0.1])
-                    sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                    sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                    sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 9: # 移动到杯盖上空
-                    tmat_lid = get_body_tmat(sim_node.mj_data, "cup_lid")
+                    tmat_lid = get_body_tmat_cached("cup_lid")
                     if pick_lip_arm == "l":
                         target_posi = tmat_lid[:3, 3] + np.array([0.0, 0.0, 0.12])
                         sim_node.tctr_lft_gripper[:] = 1
-                        sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                     elif pick_lip_arm == "r":
                         target_posi = tmat_lid[:3, 3] + np.array([0.0, 0.005, 0.12])
                         sim_node.tctr_rgt_gripper[:] = 1
-                        sim_node.rgt_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.rgt_arm_target_pose, sim_node.arm_action, "r", sim_node.sensor_rgt_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("r", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 10: # 移动到杯盖
-                    tmat_lid = get_body_tmat(sim_node.mj_data, "cup_lid")
+                    tmat_lid = get_body_tmat_cached("cup_lid")
                     target_posi[2] -= 0.055
                     if pick_lip_arm == "l":
-                        sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                     else:
-                        sim_node.rgt_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.rgt_arm_target_pose, sim_node.arm_action, "r", sim_node.sensor_rgt_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("r", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 11: # 抓住杯盖
                     if pick_lip_arm == "l":
                         sim_node.tctr_lft_gripper[:] = 0.0
@@ -163,43 +190,38 @@ if __name__ == "__main__":
                     sim_node.delay_cnt = int(0.75/sim_node.delta_t)
                 elif stm.state_idx == 12: # 提起来杯盖 移动到杯上空
                     sim_node.tctr_slide[0] = 0.1
-                    tmat_lid = get_body_tmat(sim_node.mj_data, "cup_lid")
+                    tmat_lid = get_body_tmat_cached("cup_lid")
                     target_posi = tmat_lid[:3, 3] + np.array([0.0, 0.0, 0.2])
                     if pick_lip_arm == "l":
-                        sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                     else:
-                        sim_node.rgt_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.rgt_arm_target_pose, sim_node.arm_action, "r", sim_node.sensor_rgt_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("r", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 13: # 移动到杯上空
-                    tmat_coffee = get_body_tmat(sim_node.mj_data, "coffeecup_white")
+                    tmat_coffee = get_body_tmat_cached("coffeecup_white")
                     if pick_lip_arm == "l":
                         target_posi = tmat_coffee[:3, 3] + np.array([0.0, -0.005, 0.15])
-                        sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                     else:
                         target_posi = tmat_coffee[:3, 3] + np.array([0.0, 0.005, 0.15])
-                        sim_node.rgt_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.rgt_arm_target_pose, sim_node.arm_action, "r", sim_node.sensor_rgt_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("r", target_posi, EE_ORIENTATION)
                 elif stm.state_idx == 14: # 放下杯盖
                     if pick_lip_arm == "l":
                         sim_node.tctr_lft_gripper[:] = 1
                     else:
                         sim_node.tctr_rgt_gripper[:] = 1
                 elif stm.state_idx == 15: # 移开手臂
-                    tmat_coffee = get_body_tmat(sim_node.mj_data, "coffeecup_white")
+                    tmat_coffee = get_body_tmat_cached("coffeecup_white")
                     if pick_lip_arm == "l":
                         target_posi = tmat_coffee[:3, 3] + np.array([0.0, 0.15, 0.16])
-                        sim_node.lft_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.lft_arm_target_pose, sim_node.arm_action, "l", sim_node.sensor_lft_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("l", target_posi, EE_ORIENTATION)
                     else:
                         target_posi = tmat_coffee[:3, 3] + np.array([0.0, -0.15, 0.16])
-                        sim_node.rgt_arm_target_pose[:] = sim_node.get_tmat_wrt_mmk2base(target_posi)
-                        sim_node.setArmEndTarget(sim_node.rgt_arm_target_pose, sim_node.arm_action, "r", sim_node.sensor_rgt_arm_qpos, Rotation.from_euler('zyx', [ 0., -0.0551, 0.]).as_matrix())
+                        sim_node.set_arm_target("r", target_posi, EE_ORIENTATION)
 
                 dif = np.abs(action - sim_node.target_control)
-                sim_node.joint_move_ratio = dif / (np.max(dif) + 1e-6)
-                sim_node.joint_move_ratio[2] *= 0.5
+                jmr = dif * (1.0 / (dif.max() + 1e-6))
+                jmr[2] *= 0.5
+                sim_node.joint_move_ratio = jmr
 
             elif sim_node.mj_data.time > max_time:
                 raise ValueError("Time out")
@@ -214,23 +236,31 @@ if __name__ == "__main__":
             # traceback.print_exc()
             sim_node.reset()
 
-        for i in range(2, sim_node.njctrl):
-            action[i] = step_func(action[i], sim_node.target_control[i], move_speed * sim_node.joint_move_ratio[i] * sim_node.delta_t)
-        yaw = Rotation.from_quat(np.array(obs["base_orientation"])[[1,2,3,0]]).as_euler("xyz")[2]
+        action[2:] = step_func_vec(action[2:], sim_node.target_control[2:], move_speed * sim_node.joint_move_ratio[2:] * sim_node.delta_t)
+        qw, qx, qy, qz = obs["base_orientation"]
+        yaw = math.atan2(2. * (qw * qz + qx * qy), 1. - 2. * (qy * qy + qz * qz))
         action[1] = -10 * yaw
 
         obs, _, _, _, _ = sim_node.step(action)
         
-        if len(obs_lst) < sim_node.mj_data.time * cfg.render_set["fps"]:
-            act_lst.append(action.tolist().copy())
-            obs_lst.append(obs)
+        if frame_idx < sim_node.mj_data.time * fps and frame_idx < max_frames:
+            act_buf[frame_idx] = action
+            obs_buf["time"][frame_idx] = obs["time"]
+            obs_buf["jq"][frame_idx] = obs["jq"]
+            obs_buf["base_position"][frame_idx] = obs["base_position"]
+            obs_buf["base_orientation"][frame_idx] = obs["base_orientation"]
+            for id in cfg.obs_rgb_cam_id:
+                img_buf[id][frame_idx] = obs["img"][id]
+            frame_idx += 1
 
         if stm.state_idx >= stm.max_state_cnt:
             if sim_node.check_success():
                 save_path = os.path.join(save_dir, "{:03d}".format(data_idx))
-                process = mp.Process(target=recoder_mmk2, args=(save_path, act_lst, obs_lst, cfg))
-                process.start()
-                process_list.append(process)
+                io_futures.append(io_pool.submit(
+                    recoder_mmk2_buffered, save_path, act_buf[:frame_idx].copy(),
+                    {k: v[:frame_idx].copy() for k, v in obs_buf.items()},
+                    {id: img_buf[id][:frame_idx] for id in cfg.obs_rgb_cam_id}, cfg))
+                img_buf = alloc_img_buf()
 
                 data_idx += 1
                 print("\r{:4}/{:4} ".format(data_idx, data_set_size), end="")
@@ -241,5 +271,6 @@ if __name__ == "__main__":
 
             obs = sim_node.reset()
 
-    for p in process_list:
-        p.join()
+    for future in io_futures:
+        future.result()
+    io_pool.shutdown()
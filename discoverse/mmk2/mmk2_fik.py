@@ -71,7 +71,7 @@ class MMK2FIK:
     }
 
     def __init__(self) -> None:
-        self.arm_fik = AirbotPlayFIK(urdf = os.path.join(DISCOVERSE_ASSERT_DIR, "urdf/airbot_play_v3_gripper_fixed.urdf"))
+        self.arm_fik = AirbotPlayFIK.from_cached(os.path.join(DISCOVERSE_ASSERT_DIR, "urdf/airbot_play_v3_gripper_fixed.urdf"))
     
     def get_3dposition_wrt_arm_base(self, point3d, q):
         """
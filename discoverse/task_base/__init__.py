@@ -1,5 +1,5 @@
 from .airbot_task_base import AirbotPlayTaskBase, recoder_airbot_play
-from .mmk2_task_base import MMK2TaskBase, recoder_mmk2
+from .mmk2_task_base import MMK2TaskBase, recoder_mmk2, recoder_mmk2_buffered, recoder_mmk2_shm
 
 import shutil
 def copypy2(source_py, target_py):
@@ -4,11 +4,22 @@ import shutil
 import mujoco
 import mediapy
 import numpy as np
+from multiprocessing import shared_memory
 
 from discoverse.mmk2 import MMK2FIK
 from discoverse.utils import get_body_tmat
 from discoverse.envs.mmk2_base import MMK2Base, MMK2Cfg
 
+_MMK2_FIK = None
+def get_mmk2_fik():
+    """Process-wide MMK2FIK instance. Built once in the parent so that
+    fork-started worker processes inherit the parsed arm model
+    copy-on-write instead of re-reading the URDF."""
+    global _MMK2_FIK
+    if _MMK2_FIK is None:
+        _MMK2_FIK = MMK2FIK()
+    return _MMK2_FIK
+
 def recoder_mmk2(save_path, act_lst, obs_lst, cfg):
     if os.path.exists(save_path):
         shutil.rmtree(save_path)
@@ -29,6 +40,47 @@ def recoder_mmk2(save_path, act_lst, obs_lst, cfg):
     for id in cfg.obs_rgb_cam_id:
         mediapy.write_video(os.path.join(save_path, f"cam_{id}.mp4"), [o['img'][id] for o in obs_lst], fps=cfg.render_set["fps"])
 
+def recoder_mmk2_buffered(save_path, act_arr, obs_arrs, img_arrs, cfg):
+    """recoder_mmk2 variant fed with preallocated per-episode ndarrays
+    (act (N,nctrl), low-dim obs arrays, per-camera (N,H,W,3) frames)
+    instead of per-frame dict lists."""
+    if os.path.exists(save_path):
+        shutil.rmtree(save_path)
+    os.makedirs(save_path, exist_ok=True)
+
+    with open(os.path.join(save_path, "obs_action.json"), "w") as fp:
+        obj = {
+            "time" : obs_arrs["time"].tolist(),
+            "obs"  : {
+                "jq" : obs_arrs["jq"].tolist(),
+                "base_position" : obs_arrs["base_position"].tolist(),
+                "base_orientation_wxyz" : obs_arrs["base_orientation"].tolist(),
+            },
+            "act"  : act_arr.tolist(),
+        }
+        json.dump(obj, fp)
+
+    for id in cfg.obs_rgb_cam_id:
+        mediapy.write_video(os.path.join(save_path, f"cam_{id}.mp4"), img_arrs[id], fps=cfg.render_set["fps"])
+
+def recoder_mmk2_shm(save_path, act_arr, obs_arrs, img_shm_names, img_shape_s, cfg):
+    """recoder_mmk2_buffered variant that attaches the per-camera frame
+    blocks from shared memory by name, so the driver hands frames over
+    without pickling them; each block is closed and unlinked once its
+    video is written."""
+    shm_s = []
+    img_arrs = {}
+    for id in cfg.obs_rgb_cam_id:
+        shm = shared_memory.SharedMemory(name=img_shm_names[id])
+        shm_s.append(shm)
+        img_arrs[id] = np.ndarray(img_shape_s[id], dtype=np.uint8, buffer=shm.buf)
+    try:
+        recoder_mmk2_buffered(save_path, act_arr, obs_arrs, img_arrs, cfg)
+    finally:
+        for shm in shm_s:
+            shm.close()
+            shm.unlink()
+
 
 class MMK2TaskBase(MMK2Base):
     target_control = np.zeros(19)
@@ -50,6 +102,9 @@ class MMK2TaskBase(MMK2Base):
     set_left_arm_new_target = False
     set_right_arm_new_target = False
 
+    _base_inv_cache = None
+    _base_inv_cache_time = None
+
     def __init__(self, config: MMK2Cfg):
         self.arm_action = config.init_key
         self.tctr_base = self.target_control[:2]
@@ -83,20 +138,39 @@ class MMK2TaskBase(MMK2Base):
         self.set_right_arm_new_target = False
         self.domain_randomization()
         mujoco.mj_forward(self.mj_model, self.mj_data)
+        self._base_inv_cache_time = None
         self.reset_sig = True
 
     def domain_randomization(self):
         pass
 
     def get_tmat_wrt_mmk2base(self, pose):
-        tmat_mmk2 = get_body_tmat(self.mj_data, "mmk2")
+        # the base transform only changes when the simulation steps, so the
+        # inverse is shared by every query within one tick (e.g. both arms
+        # retargeting on the same trigger)
+        if self._base_inv_cache_time != self.mj_data.time:
+            self._base_inv_cache_time = self.mj_data.time
+            self._base_inv_cache = np.linalg.inv(get_body_tmat(self.mj_data, "mmk2"))
         if pose.shape == (4,4):
-            return np.linalg.inv(tmat_mmk2) @ pose
+            return self._base_inv_cache @ pose
+        else:
+            return (self._base_inv_cache @ np.append(pose, 1))[:3]
+
+    def set_arm_target(self, arm, target_posi, a_rot=np.eye(3)):
+        """Resolve a world-frame position into the mmk2 base frame and
+        retarget one arm, bundling the target-pose bookkeeping the task
+        state machines otherwise repeat per branch."""
+        if arm == "l":
+            self.lft_arm_target_pose[:] = self.get_tmat_wrt_mmk2base(target_posi)
+            self.setArmEndTarget(self.lft_arm_target_pose, self.arm_action, "l", self.sensor_lft_arm_qpos, a_rot)
+        elif arm == "r":
+            self.rgt_arm_target_pose[:] = self.get_tmat_wrt_mmk2base(target_posi)
+            self.setArmEndTarget(self.rgt_arm_target_pose, self.arm_action, "r", self.sensor_rgt_arm_qpos, a_rot)
         else:
-            return (np.linalg.inv(tmat_mmk2) @ np.append(pose, 1))[:3]
+            raise ValueError("Invalid arm")
 
     def setArmEndTarget(self, target_pose, arm_action, arm, q_ref, a_rot):
-        rq = MMK2FIK().get_armjoint_pose_wrt_footprint(target_pose, arm_action, arm, self.tctr_slide[0], q_ref, a_rot)
+        rq = get_mmk2_fik().get_armjoint_pose_wrt_footprint(target_pose, arm_action, arm, self.tctr_slide[0], q_ref, a_rot)
         if arm == "l":
             self.tctr_left_arm[:] = rq
             self.set_left_arm_new_target = True
@@ -25,6 +25,9 @@ def step_func(current, target, step):
     else:
         return target
 
+def step_func_vec(current, target, step):
+    return current + np.clip(target - current, -step, step)
+
 def camera2k(fovy, width, height):
     cx = width / 2
     cy = height / 2